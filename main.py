@@ -1,10 +1,39 @@
+import argparse
+import os
 import pygame
 import sys
 import enum
+import functools
 import math
+import queue
+import struct
+import threading
+import time
+import zlib
 import numpy as np
+from collections import deque, namedtuple
 from pygame import MOUSEBUTTONDOWN, MOUSEBUTTONUP
 
+# Command line options
+parser = argparse.ArgumentParser(description = "Pool")
+parser.add_argument("--physics", choices = ["solver", "fixed"], default = "solver", help = "floating-point contact solver or bit-exact fixed-point physics")
+parser.add_argument("--golden", choices = ["record", "compare"], help = "record or compare golden physics trajectories instead of playing")
+parser.add_argument("--golden-file", default = "golden.npz", help = "file the golden trajectories are stored in")
+parser.add_argument("--golden-shots", type = int, default = 32, help = "number of seeded shots in the golden corpus")
+parser.add_argument("--export", metavar = "DIR", help = "render seeded shots offscreen into DIR instead of playing")
+parser.add_argument("--export-format", choices = ["png", "rgb"], default = "png", help = "PNG images or raw RGB frames")
+parser.add_argument("--export-shots", type = int, default = 8, help = "number of seeded shots to render")
+parser.add_argument("--export-size", type = int, nargs = 2, default = [1600, 900], metavar = ("WIDTH", "HEIGHT"), help = "frame size")
+parser.add_argument("--export-workers", type = int, default = 4, help = "number of writer threads")
+parser.add_argument("--pipeline", action = "store_true", help = "run the physics in a worker thread and render its published snapshots")
+parser.add_argument("--archive", metavar = "DIR", help = "append every shot to the shot archive in DIR")
+args = parser.parse_args()
+
+# Headless runs don't need a window or sound
+if args.golden or args.export:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
 # Initialize Pygame
 pygame.init()
 pygame.mixer.init()
@@ -34,6 +63,9 @@ main_font = "fonts/main_font.ttf"
 # Starting player position
 PLAYER_POS = (500, 400)
 
+# Number of shots that can be undone
+UNDO_LIMIT = 50
+
 # Set up the display
 screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.FULLSCREEN)
 pygame.display.set_caption("Pool")
@@ -113,15 +145,25 @@ class Hole(Component):
         return d < self.radius + ball.radius
 
 class Ball(Component):
+    # Extra hitbox around each ball
+    hitbox_extra = 10
+
     def __init__(self, x, y, radius, color):
         super(Ball, self).__init__(x, y)
+        self.mass = 0.2 #kg
+        self.reset(x, y, radius, color)
+
+    # Puts the ball back to a resting state in place
+    def reset(self, x, y, radius, color):
+        self.x = x
+        self.y = y
+        self.pos = (x, y)
         self.radius = radius
         self.color = color
         self.vel_x = 0.0
         self.vel_y = 0.0
         self.theta = 0.0
         self.vel_main = 0.0
-        self.mass = 0.2 #kg
         self.moving = False
 
     def draw(self, surface):
@@ -150,9 +192,7 @@ class Ball(Component):
     def check_ball_collision(self, ball2):
         dx = self.x - ball2.x
         dy = self.y - ball2.y
-        # Extra hitbox
-        hitbox_extra = 10
-        return math.hypot(dx, dy) < self.radius + ball2.radius + hitbox_extra
+        return math.hypot(dx, dy) < self.radius + ball2.radius + self.hitbox_extra
 
     # Returns the tangent point/collision point
     def get_collision_point(self, ball2):
@@ -242,6 +282,12 @@ class Ball(Component):
 
         return ball_list
 
+    # Resets pooled balls from BALL_DEFS without allocating new ones
+    @staticmethod
+    def reset_balls(ball_list):
+        for ball, defs in zip(ball_list, BALL_DEFS):
+            ball.reset(*defs)
+
 class Player(Ball):
     def __init__(self, x, y, radius):
         super(Player, self).__init__(x, y, radius, Color.WHITE)
@@ -262,11 +308,852 @@ class Player(Ball):
         self.vel_y = self.vel_main * math.sin(self.theta)
         self.vel_x = self.vel_main * math.cos(self.theta)
 
+    # Returns the aimed angle in ANGLE_UNITS and the Q16.16 power using integer math only
+    def get_fixed_aim(self):
+        mouse_x, mouse_y = pygame.mouse.get_pos()
+        dx = round(self.x * FIXED_ONE) - mouse_x * FIXED_ONE
+        dy = round(self.y * FIXED_ONE) - mouse_y * FIXED_ONE
+        power = math.isqrt(math.isqrt(dx * dx + dy * dy) << FIXED_SHIFT)
+
+        return fixed_atan2(dy, dx), max(MIN_BALL_SPEED * FIXED_ONE, min(power, MAX_BALL_SPEED * FIXED_ONE))
+
     def set_existing_vector(self):
         # Gets the new movement vector from the existing one
         self.vel_x *= math.cos(self.theta)
         self.vel_y *= math.sin(self.theta)
 
+# Resolves every ball contact of a frame together
+class ContactSolver:
+    def __init__(self, iterations = 8, restitution = 1.0, correction = 0.8, slop = 0.5):
+        self.iterations = iterations
+        self.restitution = restitution
+        # Fraction of the overlap removed per correction pass
+        self.correction = correction
+        # Overlap left alone to avoid jitter between resting balls
+        self.slop = slop
+
+    # Returns the (i, j) index pairs of touching balls
+    @staticmethod
+    def find_contacts(balls):
+        n = len(balls)
+        if n < 2:
+            return []
+
+        xs = np.fromiter((ball.x for ball in balls), float, n)
+        ys = np.fromiter((ball.y for ball in balls), float, n)
+        radii = np.fromiter((ball.radius for ball in balls), float, n)
+
+        i, j = np.triu_indices(n, 1)
+        reach = radii[i] + radii[j] + Ball.hitbox_extra
+        dist_sq = (xs[i] - xs[j]) ** 2 + (ys[i] - ys[j]) ** 2
+        touching = dist_sq < reach ** 2
+
+        return list(zip(i[touching].tolist(), j[touching].tolist()))
+
+    # Resolves all contacts with a fixed number of sequential-impulse passes
+    # Impulses are still applied in find_contacts order, so results depend on that order;
+    # what the fixed passes give is a bounded cost per frame
+    # Returns the number of contacts that exchanged momentum
+    def solve(self, balls):
+        contacts = []
+        for i, j in self.find_contacts(balls):
+            ball1, ball2 = balls[i], balls[j]
+            dx = ball2.x - ball1.x
+            dy = ball2.y - ball1.y
+            d = math.hypot(dx, dy)
+            if d == 0:
+                nx, ny = 1.0, 0.0
+            else:
+                nx, ny = dx / d, dy / d
+
+            inv_m1 = 1 / ball1.mass
+            inv_m2 = 1 / ball2.mass
+            k = 1 / (inv_m1 + inv_m2)
+
+            # Target separating speed; contacts already separating only need correcting
+            vn = (ball2.vel_x - ball1.vel_x) * nx + (ball2.vel_y - ball1.vel_y) * ny
+            bias = -self.restitution * vn if vn < 0 else 0.0
+
+            # [ball1, ball2, nx, ny, inv_m1, inv_m2, k, bias, accumulated impulse]
+            contacts.append([ball1, ball2, nx, ny, inv_m1, inv_m2, k, bias, 0.0])
+
+        for _ in range(self.iterations):
+            for contact in contacts:
+                ball1, ball2, nx, ny, inv_m1, inv_m2, k, bias, total = contact
+                vn = (ball2.vel_x - ball1.vel_x) * nx + (ball2.vel_y - ball1.vel_y) * ny
+
+                # Impulses only ever push balls apart
+                new_total = max(total + k * (bias - vn), 0.0)
+                impulse = new_total - total
+                contact[8] = new_total
+
+                ball1.vel_x -= impulse * inv_m1 * nx
+                ball1.vel_y -= impulse * inv_m1 * ny
+                ball2.vel_x += impulse * inv_m2 * nx
+                ball2.vel_y += impulse * inv_m2 * ny
+
+        self.correct_positions(contacts)
+
+        hits = 0
+        for ball1, ball2, *_, total in contacts:
+            if total > 0:
+                ball1.moving = True
+                ball2.moving = True
+                hits += 1
+
+        return hits
+
+    # Pushes overlapping balls apart, sharing the move by inverse mass
+    def correct_positions(self, contacts):
+        for _ in range(self.iterations):
+            for ball1, ball2, nx, ny, inv_m1, inv_m2, *_ in contacts:
+                dx = ball2.x - ball1.x
+                dy = ball2.y - ball1.y
+                d = math.hypot(dx, dy)
+                overlap = ball1.radius + ball2.radius - d - self.slop
+                if overlap <= 0:
+                    continue
+
+                if d > 0:
+                    nx, ny = dx / d, dy / d
+
+                push = self.correction * overlap / (inv_m1 + inv_m2)
+                ball1.x -= push * inv_m1 * nx
+                ball1.y -= push * inv_m1 * ny
+                ball2.x += push * inv_m2 * nx
+                ball2.y += push * inv_m2 * ny
+
+        for ball1, ball2, *_ in contacts:
+            ball1.pos = (ball1.x, ball1.y)
+            ball2.pos = (ball2.x, ball2.y)
+
+# Runs the wall, ball and hole checks of one frame
+# Pocketed balls are removed from balls; returns (wall hits, ball hits, pocketed balls)
+def resolve_table(player, balls, solver):
+    wall_hits = 0
+    for wall in WALLS:
+        for ball in [player] + balls:
+            if ball.moving:
+                wall_collision = wall.check_collision(ball.x, ball.y, ball.radius)
+                # Returns [hasCollided, isCollisionVertical]
+                if wall_collision[0]:
+                    if wall_collision[1]:
+                        ball.vel_x = -ball.vel_x
+                    else:
+                        ball.vel_y = -ball.vel_y
+
+                    wall_hits += 1
+
+    # Resolves all ball contacts (player included) together
+    ball_hits = solver.solve([player] + balls)
+
+    pocketed = []
+    for ball in balls[:]:
+        # Checks if any ball went inside the hole
+        for hole in HOLES:
+            if hole.check_ball_in_hole(ball):
+                balls.remove(ball)
+                pocketed.append(ball)
+                break
+
+    return wall_hits, ball_hits, pocketed
+
+# Headless physics engine running on private copies of the balls
+# Subclasses provide step(); alternative engines may also override load, shoot and read
+class Engine:
+    name = "engine"
+
+    def __init__(self):
+        self.cue = Player(*PLAYER_POS, radius = 15)
+        self.pool = Ball.get_new_balls()
+        self.balls = []
+        self.pocketed = []
+
+    # Loads a TableState onto the private balls
+    def load(self, state):
+        rows = state.balls.tolist()
+        moving = state.moving.tolist()
+        for ball, row, is_moving in zip([self.cue] + self.pool, rows, moving):
+            ball.x, ball.y, ball.vel_x, ball.vel_y, ball.theta, ball.vel_main = row
+            ball.pos = (ball.x, ball.y)
+            ball.moving = is_moving
+
+        self.pocketed = list(state.pocketed)
+        self.balls = [ball for i, ball in enumerate(self.pool) if i not in state.pocketed]
+
+    # Strikes the cue ball the same way a mouse click does
+    def shoot(self, theta, vel_main):
+        self.cue.theta = theta
+        self.cue.vel_main = max(MIN_BALL_SPEED, min(vel_main, MAX_BALL_SPEED))
+        self.cue.moving = True
+        self.cue.set_update_vector()
+
+    # Advances the table by one frame
+    def step(self):
+        raise NotImplementedError
+
+    def is_moving(self):
+        return self.cue.moving or any(ball.moving for ball in self.balls)
+
+    # Moving flag per row; row 0 is the cue ball
+    def moving_mask(self):
+        return np.array([ball.moving for ball in [self.cue] + self.pool], dtype = bool)
+
+    # Returns positions (n, 2), velocities (n, 2) and the on-table mask (n,); row 0 is the cue ball
+    def read(self):
+        balls = [self.cue] + self.pool
+        positions = np.array([(ball.x, ball.y) for ball in balls], dtype = np.float64)
+        velocities = np.array([(ball.vel_x, ball.vel_y) for ball in balls], dtype = np.float64)
+        on_table = np.ones(len(balls), dtype = bool)
+        on_table[[i + 1 for i in self.pocketed]] = False
+
+        return positions, velocities, on_table
+
+    # Pool indices of the pocketed balls, in order
+    def outcome(self):
+        return tuple(self.pocketed)
+
+    def track_pocketed(self, pocketed):
+        for ball in pocketed:
+            self.pocketed.append(self.pool.index(ball))
+
+# The original pairwise physics of Game.run: Ball.collide and displace_overlap in list order
+class ReferenceEngine(Engine):
+    name = "reference"
+
+    def step(self):
+        cue, balls = self.cue, self.balls
+        for ball in [cue] + balls:
+            ball.update()
+
+        for wall in WALLS:
+            for ball in [cue] + balls:
+                if ball.moving:
+                    wall_collision = wall.check_collision(ball.x, ball.y, ball.radius)
+                    if wall_collision[0]:
+                        if wall_collision[1]:
+                            ball.vel_x = -ball.vel_x
+                        else:
+                            ball.vel_y = -ball.vel_y
+
+        for i, ball in enumerate(balls):
+            Ball.displace_overlap(ball, cue)
+            if ball.check_ball_collision(cue):
+                ball.collide(cue)
+
+            for j in range(i + 1, len(balls)):
+                ball2 = balls[j]
+                Ball.displace_overlap(ball, ball2)
+                if ball.check_ball_collision(ball2):
+                    ball.collide(ball2)
+
+            for hole in HOLES:
+                if hole.check_ball_in_hole(ball):
+                    balls.remove(ball)
+                    self.track_pocketed([ball])
+
+        if cue.moving:
+            cue.update()
+
+# The physics the game runs: resolve_table with the ContactSolver
+class SolverEngine(Engine):
+    name = "solver"
+
+    def __init__(self):
+        super(SolverEngine, self).__init__()
+        self.solver = ContactSolver()
+
+    def step(self):
+        for ball in [self.cue] + self.balls:
+            ball.update()
+
+        self.track_pocketed(resolve_table(self.cue, self.balls, self.solver)[2])
+        if self.cue.moving:
+            self.cue.update()
+
+# Fixed-point physics: Q16.16 integers and binary angles with ANGLE_UNITS per turn
+FIXED_SHIFT = 16
+FIXED_ONE = 1 << FIXED_SHIFT
+ANGLE_UNITS = 1 << 14
+
+# Builds the quarter-wave sine table in FIXED_ONE units
+# Only integer arithmetic is used, so the table is identical on every platform
+def build_sin_table():
+    scale = 1 << 96
+
+    # Machin's formula for pi
+    def arctan_inv(x):
+        total, term, n, sign = 0, scale // x, 1, 1
+        while term:
+            total += sign * (term // n)
+            term //= x * x
+            n += 2
+            sign = -sign
+        return total
+
+    pi = 4 * (4 * arctan_inv(5) - arctan_inv(239))
+    step = 2 * pi // ANGLE_UNITS
+
+    # Taylor series starting from the given term
+    def series(term, n):
+        total, sign = 0, 1
+        while term:
+            total += sign * term
+            term = term * step // scale * step // scale // ((n + 1) * (n + 2))
+            n += 2
+            sign = -sign
+        return total
+
+    sin_step, cos_step = series(step, 1), series(scale, 0)
+
+    table = []
+    s, c = 0, scale
+    for _ in range(ANGLE_UNITS // 4 + 1):
+        table.append((s * FIXED_ONE + scale // 2) // scale)
+        s, c = (s * cos_step + c * sin_step) // scale, (c * cos_step - s * sin_step) // scale
+
+    return table
+
+FIXED_SIN = build_sin_table()
+
+def fixed_sin(angle):
+    quarter = ANGLE_UNITS // 4
+    angle %= ANGLE_UNITS
+    if angle < quarter:
+        return FIXED_SIN[angle]
+    elif angle < 2 * quarter:
+        return FIXED_SIN[2 * quarter - angle]
+    elif angle < 3 * quarter:
+        return -FIXED_SIN[angle - 2 * quarter]
+    return -FIXED_SIN[ANGLE_UNITS - angle]
+
+def fixed_cos(angle):
+    return fixed_sin(angle + ANGLE_UNITS // 4)
+
+# Angle of the integer vector (x, y) in ANGLE_UNITS, found by binary search on the sine table
+def fixed_atan2(y, x):
+    if x == 0 and y == 0:
+        return 0
+
+    quarter = ANGLE_UNITS // 4
+
+    # Rotates by -90 deg until the vector is in the first quadrant
+    turns = 0
+    while not (x > 0 and y >= 0):
+        x, y = y, -x
+        turns += 1
+
+    low, high = 0, quarter
+    while low < high:
+        mid = (low + high) // 2
+        if FIXED_SIN[mid] * x < FIXED_SIN[quarter - mid] * y:
+            low = mid + 1
+        else:
+            high = mid
+
+    return (low + turns * quarter) % ANGLE_UNITS
+
+# Bit-exact physics on int32 Q16.16 state, mirroring SolverEngine
+# Every step uses integer arithmetic only, so the same inputs give the same table everywhere
+class FixedPointEngine(Engine):
+    name = "fixed"
+    iterations = 8
+    correction = round(0.8 * FIXED_ONE)
+    slop = FIXED_ONE // 2
+    friction = round(FRICTION * FIXED_ONE)
+    rest_speed = round(0.01 * FIXED_ONE)
+
+    def __init__(self):
+        super(FixedPointEngine, self).__init__()
+        balls = [self.cue] + self.pool
+        n = len(balls)
+        self.radius = np.array([ball.radius for ball in balls], dtype = np.int64) * FIXED_ONE
+        self.inv_mass = [round(FIXED_ONE / ball.mass) for ball in balls]
+        self.positions = np.zeros((n, 2), dtype = np.int32)
+        self.velocities = np.zeros((n, 2), dtype = np.int32)
+        self.moving = np.zeros(n, dtype = bool)
+        self.on_table = np.ones(n, dtype = bool)
+        self.walls = [tuple(v * FIXED_ONE for v in (wall.rect.left, wall.rect.top, wall.rect.right, wall.rect.bottom)) for wall in WALLS]
+        self.holes = np.array([(hole.x, hole.y, hole.radius) for hole in HOLES], dtype = np.int64) * FIXED_ONE
+        self.wall_hits = 0
+        self.ball_hits = 0
+
+    def load(self, state):
+        self.positions[:] = np.rint(state.balls[:, :2] * FIXED_ONE)
+        self.velocities[:] = np.rint(state.balls[:, 2:4] * FIXED_ONE)
+        self.moving[:] = state.moving
+        self.on_table[:] = True
+        self.on_table[[i + 1 for i in state.pocketed]] = False
+        self.pocketed = list(state.pocketed)
+
+    # Quantizes a float shot to the fixed-point inputs
+    def shoot(self, theta, vel_main):
+        angle = round(theta / (2 * math.pi) * ANGLE_UNITS) % ANGLE_UNITS
+        power = round(max(MIN_BALL_SPEED, min(vel_main, MAX_BALL_SPEED)) * FIXED_ONE)
+        self.shoot_fixed(angle, power)
+
+    # Strikes the cue ball with an angle in ANGLE_UNITS and a Q16.16 power
+    def shoot_fixed(self, angle, power):
+        self.velocities[0] = (power * fixed_cos(angle) >> FIXED_SHIFT, power * fixed_sin(angle) >> FIXED_SHIFT)
+        self.moving[0] = True
+
+    def is_moving(self):
+        return bool((self.moving & self.on_table).any())
+
+    def moving_mask(self):
+        return self.moving & self.on_table
+
+    def read(self):
+        return self.positions / FIXED_ONE, self.velocities / FIXED_ONE, self.on_table.copy()
+
+    # Ball.update for the balls in mask
+    def advance(self, positions, velocities, mask):
+        positions[mask] += velocities[mask]
+        v = velocities[mask]
+        velocities[mask] = np.sign(v) * ((np.abs(v) * self.friction) >> FIXED_SHIFT)
+
+        stopped = mask & (np.abs(velocities) < self.rest_speed).all(axis = 1)
+        self.moving[stopped] = False
+        velocities[stopped] = 0
+
+    def step(self):
+        positions = self.positions.astype(np.int64)
+        velocities = self.velocities.astype(np.int64)
+        self.advance(positions, velocities, self.moving & self.on_table)
+
+        # Wall reflections, one wall at a time like Wall.check_collision
+        self.wall_hits = 0
+        for left, top, right, bottom in self.walls:
+            dx = positions[:, 0] - np.clip(positions[:, 0], left, right)
+            dy = positions[:, 1] - np.clip(positions[:, 1], top, bottom)
+            hit = self.moving & self.on_table & (dx * dx + dy * dy < self.radius ** 2)
+            vertical = np.abs(dx) > np.abs(dy)
+            velocities[hit & vertical, 0] *= -1
+            velocities[hit & ~vertical, 1] *= -1
+            self.wall_hits += int(hit.sum())
+
+        self.ball_hits = self.solve(positions, velocities)
+
+        # Holes
+        reach = self.holes[:, 2] + self.radius[:, None]
+        dx = positions[:, 0, None] - self.holes[:, 0]
+        dy = positions[:, 1, None] - self.holes[:, 1]
+        in_hole = (dx * dx + dy * dy < reach ** 2).any(axis = 1) & self.on_table
+        in_hole[0] = False
+        for i in np.flatnonzero(in_hole).tolist():
+            self.on_table[i] = False
+            self.pocketed.append(i - 1)
+
+        if self.moving[0]:
+            cue = np.zeros_like(self.moving)
+            cue[0] = True
+            self.advance(positions, velocities, cue)
+
+        self.positions[:] = positions
+        self.velocities[:] = velocities
+
+    # ContactSolver on Python integers; returns the number of contacts that exchanged momentum
+    def solve(self, positions, velocities):
+        index = np.flatnonzero(self.on_table)
+        i, j = np.triu_indices(len(index), 1)
+        i, j = index[i], index[j]
+        reach = self.radius[i] + self.radius[j] + Ball.hitbox_extra * FIXED_ONE
+        delta = positions[j] - positions[i]
+        touching = (delta ** 2).sum(axis = 1) < reach ** 2
+        if not touching.any():
+            return 0
+
+        p = positions.tolist()
+        v = velocities.tolist()
+        inv = self.inv_mass
+        contacts = []
+        for a, b in zip(i[touching].tolist(), j[touching].tolist()):
+            dx = p[b][0] - p[a][0]
+            dy = p[b][1] - p[a][1]
+            d = math.isqrt(dx * dx + dy * dy)
+            if d == 0:
+                nx, ny = FIXED_ONE, 0
+            else:
+                nx, ny = dx * FIXED_ONE // d, dy * FIXED_ONE // d
+
+            w1 = inv[a] * FIXED_ONE // (inv[a] + inv[b])
+            vn = ((v[b][0] - v[a][0]) * nx + (v[b][1] - v[a][1]) * ny) >> FIXED_SHIFT
+            bias = -vn if vn < 0 else 0
+
+            # [a, b, nx, ny, share of a, share of b, bias, accumulated relative speed change]
+            contacts.append([a, b, nx, ny, w1, FIXED_ONE - w1, bias, 0])
+
+        for _ in range(self.iterations):
+            for contact in contacts:
+                a, b, nx, ny, w1, w2, bias, total = contact
+                vn = ((v[b][0] - v[a][0]) * nx + (v[b][1] - v[a][1]) * ny) >> FIXED_SHIFT
+                new_total = max(total + bias - vn, 0)
+                change = new_total - total
+                contact[7] = new_total
+
+                ix = change * nx >> FIXED_SHIFT
+                iy = change * ny >> FIXED_SHIFT
+                v[a][0] -= ix * w1 >> FIXED_SHIFT
+                v[a][1] -= iy * w1 >> FIXED_SHIFT
+                v[b][0] += ix * w2 >> FIXED_SHIFT
+                v[b][1] += iy * w2 >> FIXED_SHIFT
+
+        for _ in range(self.iterations):
+            for a, b, nx, ny, w1, w2, *_ in contacts:
+                dx = p[b][0] - p[a][0]
+                dy = p[b][1] - p[a][1]
+                d = math.isqrt(dx * dx + dy * dy)
+                overlap = int(self.radius[a] + self.radius[b]) - d - self.slop
+                if overlap <= 0:
+                    continue
+
+                if d > 0:
+                    nx, ny = dx * FIXED_ONE // d, dy * FIXED_ONE // d
+
+                push = overlap * self.correction >> FIXED_SHIFT
+                px = push * nx >> FIXED_SHIFT
+                py = push * ny >> FIXED_SHIFT
+                p[a][0] -= px * w1 >> FIXED_SHIFT
+                p[a][1] -= py * w1 >> FIXED_SHIFT
+                p[b][0] += px * w2 >> FIXED_SHIFT
+                p[b][1] += py * w2 >> FIXED_SHIFT
+
+        hits = 0
+        for a, b, *_, total in contacts:
+            if total > 0:
+                self.moving[a] = True
+                self.moving[b] = True
+                hits += 1
+
+        positions[:] = p
+        velocities[:] = v
+
+        return hits
+
+# Renders shots offscreen as fast as possible and streams the frames to disk
+# Frames go through a bounded queue to a pool of writer threads, so memory stays constant
+class FrameExporter:
+    def __init__(self, directory, size, image_format = "png", workers = 4, queue_size = 16):
+        self.directory = directory
+        self.size = size
+        self.image_format = image_format
+        # 32 bits per pixel whatever the display uses, so write_frame can rely on the layout
+        self.surface = pygame.Surface(size, 0, 32)
+        # Byte offsets of red, green and blue inside a surface pixel
+        self.channels = [shift // 8 if sys.byteorder == "little" else 3 - shift // 8 for shift in self.surface.get_shifts()[:3]]
+        self.frames = queue.Queue(maxsize = queue_size)
+        self.count = 0
+        # First error raised by a writer
+        self.error = None
+        os.makedirs(directory, exist_ok = True)
+
+        self.workers = [threading.Thread(target = self.write, daemon = True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def write(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+
+            # After a failure the queue is still drained so submit and close never block
+            if self.error is not None:
+                continue
+
+            try:
+                self.write_frame(*item)
+            except Exception as error:
+                self.error = error
+
+    # Surface rows to packed RGB; NumPy and zlib release the GIL, so the writers run in parallel
+    def write_frame(self, index, data):
+        width, height = self.size
+        pitch = self.surface.get_pitch()
+        pixels = np.frombuffer(data, np.uint8).reshape(height, pitch)[:, :width * 4].reshape(height, width, 4)[..., self.channels]
+
+        path = os.path.join(self.directory, f"frame_{index:06d}.{self.image_format}")
+        with open(path, "wb") as file:
+            file.write(self.encode_png(pixels) if self.image_format == "png" else pixels.tobytes())
+
+    # Encodes an (height, width, 3) uint8 array as a PNG
+    @staticmethod
+    def encode_png(pixels, level = 1):
+        height, width = pixels.shape[:2]
+
+        # Every row starts with filter type 0
+        rows = np.zeros((height, width * 3 + 1), dtype = np.uint8)
+        rows[:, 1:] = pixels.reshape(height, -1)
+
+        def chunk(kind, body):
+            return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows.tobytes(), level)) + chunk(b"IEND", b"")
+
+    # Queues a copy of the surface pixels; blocks while the writers are behind
+    def submit(self):
+        if self.error is not None:
+            raise self.error
+
+        self.frames.put((self.count, self.surface.get_buffer().raw))
+        self.count += 1
+
+    # Plays each (table state, theta, vel_main) shot until the table has been still for hold frames
+    def export(self, game, shots, hold = FPS // 2, max_frames = 20 * FPS):
+        for state, theta, vel_main in shots:
+            game.restore(state)
+            game.shoot(theta, vel_main)
+
+            frames = still = 0
+            while still < hold and frames < max_frames:
+                game.step()
+                game.draw(self.surface)
+                self.submit()
+                frames += 1
+                still = 0 if game.is_moving() else still + 1
+
+        return self.count
+
+    # Waits for every queued frame to be written
+    def close(self):
+        for _ in self.workers:
+            self.frames.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        if self.error is not None:
+            raise self.error
+
+# Records reference trajectories for a corpus of seeded shots and replays them through other engines
+class GoldenHarness:
+    # Timings are the best of this many runs
+    repeats = 3
+
+    def __init__(self, shots = 32, frames = 300, seed = 0):
+        self.frames = frames
+        self.seed = seed
+        self.masses = np.array([ball.mass for ball in [PLAYER] + BALL_POOL])
+        self.corpus = [self.make_shot(seed + i) for i in range(shots)]
+        self.golden = None
+
+    # Returns (table state, theta, vel_main) of a random cue position and shot on a fresh rack
+    @staticmethod
+    def make_shot(seed):
+        rng = np.random.default_rng(seed)
+        state = rack_state()
+        rows = state.balls.copy()
+        while True:
+            x, y = rng.uniform(150, 1450), rng.uniform(150, 750)
+            gaps = np.hypot(rows[1:, 0] - x, rows[1:, 1] - y)
+            if gaps.min() > 50 and not any(math.hypot(hole.x - x, hole.y - y) < 80 for hole in HOLES):
+                break
+
+        rows[0, :2] = (x, y)
+        rows.flags.writeable = False
+        theta = rng.uniform(-math.pi, math.pi)
+        vel_main = rng.uniform(MIN_BALL_SPEED, MAX_BALL_SPEED)
+
+        return state._replace(balls = rows), theta, vel_main
+
+    # Plays every shot through an engine
+    # Returns positions (shots, frames + 1, n, 2), velocities, on-table masks, outcomes and the time spent stepping
+    def play(self, engine):
+        n = len(self.masses)
+        positions = np.zeros((len(self.corpus), self.frames + 1, n, 2))
+        velocities = np.zeros_like(positions)
+        on_table = np.zeros((len(self.corpus), self.frames + 1, n), dtype = bool)
+        outcomes = []
+        elapsed = 0.0
+
+        for s, (state, theta, vel_main) in enumerate(self.corpus):
+            engine.load(state)
+            engine.shoot(theta, vel_main)
+            positions[s, 0], velocities[s, 0], on_table[s, 0] = engine.read()
+
+            for f in range(1, self.frames + 1):
+                if engine.is_moving():
+                    start = time.perf_counter()
+                    engine.step()
+                    elapsed += time.perf_counter() - start
+
+                positions[s, f], velocities[s, f], on_table[s, f] = engine.read()
+
+            outcomes.append(engine.outcome())
+
+        return positions, velocities, on_table, outcomes, elapsed
+
+    # Keeps positions, velocities, on-table masks and outcomes as the golden run
+    def record(self, engine = None):
+        self.golden = self.play(engine or ReferenceEngine())[:4]
+        return self.golden
+
+    def save(self, path):
+        positions, velocities, on_table, outcomes = self.golden
+        pocketed = np.full((len(outcomes), len(BALL_POOL)), -1, dtype = np.int8)
+        for s, outcome in enumerate(outcomes):
+            pocketed[s, :len(outcome)] = outcome
+
+        # The shots themselves are stored too, so the file replays without the current rack or RNG code
+        shot_pocketed = np.full((len(self.corpus), len(BALL_POOL)), -1, dtype = np.int8)
+        for s, (state, theta, vel_main) in enumerate(self.corpus):
+            shot_pocketed[s, :len(state.pocketed)] = state.pocketed
+
+        np.savez_compressed(
+            path, positions = positions, velocities = velocities, on_table = on_table, pocketed = pocketed, seed = self.seed,
+            shot_balls = np.stack([state.balls for state, _, _ in self.corpus]),
+            shot_moving = np.stack([state.moving for state, _, _ in self.corpus]),
+            shot_pocketed = shot_pocketed,
+            shot_theta = np.array([theta for _, theta, _ in self.corpus]),
+            shot_vel_main = np.array([vel_main for _, _, vel_main in self.corpus])
+        )
+
+    def load(self, path):
+        data = np.load(path)
+        if data["shot_balls"].shape[1] != len(self.masses):
+            raise ValueError(f"{path} was recorded with {data['shot_balls'].shape[1]} balls, the table has {len(self.masses)}")
+
+        outcomes = [tuple(int(i) for i in row if i >= 0) for row in data["pocketed"]]
+        self.golden = (data["positions"], data["velocities"], data["on_table"], outcomes)
+        self.frames = data["positions"].shape[1] - 1
+        self.seed = int(data["seed"])
+
+        self.corpus = []
+        for balls, moving, pocketed, theta, vel_main in zip(data["shot_balls"], data["shot_moving"], data["shot_pocketed"], data["shot_theta"], data["shot_vel_main"]):
+            balls.flags.writeable = False
+            moving.flags.writeable = False
+            state = TableState(balls, moving, tuple(int(i) for i in pocketed if i >= 0), 0, 0, None, Team.RED)
+            self.corpus.append((state, float(theta), float(vel_main)))
+
+    # Kinetic energy (shots, frames + 1) and momentum (shots, frames + 1, 2) of the balls on the table
+    def energy_momentum(self, velocities, on_table):
+        masses = self.masses * on_table
+        energy = 0.5 * (masses * (velocities ** 2).sum(axis = -1)).sum(axis = -1)
+        momentum = (masses[..., None] * velocities).sum(axis = -2)
+
+        return energy, momentum
+
+    # Time ReferenceEngine takes to step the corpus in this process
+    def time_reference(self):
+        return min(self.play(ReferenceEngine())[4] for _ in range(self.repeats))
+
+    # Replays the corpus through an engine and compares it against the golden run
+    # Speedup is measured against reference_time, timed now when not given
+    def compare(self, engine, reference_time = None):
+        if reference_time is None:
+            reference_time = self.time_reference()
+
+        ref_pos, ref_vel, ref_on, ref_out = self.golden
+        pos, vel, on, out, elapsed = self.play(engine)
+        elapsed = min([elapsed] + [self.play(engine)[4] for _ in range(self.repeats - 1)])
+
+        ref_energy, ref_momentum = self.energy_momentum(ref_vel, ref_on)
+        energy, momentum = self.energy_momentum(vel, on)
+        drift = np.hypot(*(pos - ref_pos).transpose(3, 0, 1, 2))
+
+        return {
+            "engine": engine.name,
+            "max_drift": float(drift.max()),
+            "mean_drift": float(drift.mean()),
+            "outcome_mismatches": sum(a != b for a, b in zip(ref_out, out)),
+            "max_energy_delta": float(np.abs(energy - ref_energy).max()),
+            "max_momentum_delta": float(np.linalg.norm(momentum - ref_momentum, axis = -1).max()),
+            "speedup": reference_time / elapsed if elapsed else float("inf")
+        }
+
+    # Prints one row per engine
+    def report(self, engines):
+        columns = ["engine", "max_drift", "mean_drift", "outcome_mismatches", "max_energy_delta", "max_momentum_delta", "speedup"]
+        print(" | ".join(f"{column:>18}" for column in columns))
+        reference_time = self.time_reference()
+        for engine in engines:
+            result = self.compare(engine, reference_time)
+            print(" | ".join(f"{result[column]:>18.4f}" if isinstance(result[column], float) else f"{result[column]:>18}" for column in columns))
+
+# Predicts the shot being aimed with a headless rollout on private copies of the balls
+# Rollouts run in a background thread and are cached by quantized angle, power and table state
+class AimPreview:
+    angle_step = math.radians(0.25)
+    power_step = 0.5
+    max_frames = 120
+    deflection_length = 150
+
+    def __init__(self):
+        self.engine = FixedPointEngine() if args.physics == "fixed" else SolverEngine()
+        self.key = None
+        # (cue path, ghost ball position, first ball hit position, deflection unit vector)
+        self.result = None
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target = self.work, daemon = True)
+        self.worker.start()
+
+    # Asks for a new rollout when the quantized aim or the table changed
+    def request(self, theta, vel_main, state):
+        vel_main = max(MIN_BALL_SPEED, min(vel_main, MAX_BALL_SPEED))
+        # Only positions, velocities and motion describe the table; the aim columns change with every mouse move
+        key = (round(theta / self.angle_step), round(vel_main / self.power_step), state.balls[:, :4].tobytes(), state.moving.tobytes(), state.pocketed)
+        if key != self.key:
+            self.key = key
+            self.requests.put((key, state))
+
+    def work(self):
+        while True:
+            key, state = self.requests.get()
+            # Only the most recent aim matters
+            while not self.requests.empty():
+                key, state = self.requests.get()
+
+            self.result = self.rollout(key[0] * self.angle_step, key[1] * self.power_step, state)
+
+    # Plays the shot out on the private balls and returns the preview
+    def rollout(self, theta, vel_main, state):
+        engine = self.engine
+        engine.load(state)
+        engine.shoot(theta, vel_main)
+
+        positions, velocities, on_table = engine.read()
+        path = [tuple(positions[0])]
+        ghost = target = deflection = None
+        for _ in range(self.max_frames):
+            resting = ~engine.moving_mask()
+            previous = positions
+            engine.step()
+            positions, velocities, on_table = engine.read()
+            path.append(tuple(positions[0]))
+
+            if target is None:
+                struck = np.flatnonzero(resting[1:] & engine.moving_mask()[1:] & on_table[1:])
+                if len(struck):
+                    i = struck[0] + 1
+                    vel_x, vel_y = velocities[i]
+                    speed = math.hypot(vel_x, vel_y)
+                    deflection = (vel_x / speed, vel_y / speed)
+
+                    # The step moves the cue on past the contact, so the ghost ball is placed
+                    # at contact distance behind the struck ball along its deflection
+                    target = tuple(previous[i])
+                    reach = engine.cue.radius + engine.pool[i - 1].radius + Ball.hitbox_extra
+                    ghost = (target[0] - deflection[0] * reach, target[1] - deflection[1] * reach)
+
+            if not engine.is_moving():
+                break
+
+        return path, ghost, target, deflection
+
+    def draw(self, surface):
+        if self.result is None:
+            return
+
+        path, ghost, target, deflection = self.result
+        if len(path) > 1:
+            pygame.draw.lines(surface, Color.WHITE.value, False, path, 1)
+
+        if ghost is not None:
+            pygame.draw.circle(surface, Color.WHITE.value, ghost, self.engine.cue.radius, 2)
+            end = (target[0] + deflection[0] * self.deflection_length, target[1] + deflection[1] * self.deflection_length)
+            pygame.draw.line(surface, Color.BLACK.value, target, end, 3)
+
 class Text(Component):
     def __init__(self, x, y, text, size):
         super(Text, self).__init__(x, y)
@@ -274,13 +1161,21 @@ class Text(Component):
         self.size = size
         self.font = pygame.font.Font(main_font, size)
         self.custom_font = self.font.render(self.text, True, Color.BLACK.value)
+        # Rendered surface per string; scores only ever show a handful of strings
+        self.renders = {self.text: self.custom_font}
 
     def draw(self, surface):
         surface.blit(self.custom_font, (self.x, self.y))
 
     def update_text(self, new_text):
+        # Strings seen before reuse their surface
+        if new_text == self.text:
+            return
+
         self.text = new_text
-        self.custom_font = self.font.render(self.text, True, Color.BLACK.value)
+        if new_text not in self.renders:
+            self.renders[new_text] = self.font.render(new_text, True, Color.BLACK.value)
+        self.custom_font = self.renders[new_text]
 
 class Button(Component):
     def __init__(self, x, y, width, height, text: Text, action = None):
@@ -337,55 +1232,296 @@ BUTTON_DEFS = [
     (1400, 5, 150, 50, Text(text = "Restart", x = 0, y = 0, size = 40), lambda: game.restart_game() if game.winner is None else None)
 ]
 
+# Immutable snapshot of the whole table
+# balls: read-only float64 rows of (x, y, vel_x, vel_y, theta, vel_main); row 0 is the player, the rest follow BALL_POOL
+# moving: read-only bool per row
+# pocketed: BALL_POOL indices in the order they were pocketed
+# team: the team to shoot next
+TableState = namedtuple("TableState", ["balls", "moving", "pocketed", "score_red", "score_blue", "winner", "team"])
+
+# Returns the TableState of a freshly racked table
+def rack_state():
+    rows = np.zeros((len(BALL_DEFS) + 1, 6))
+    rows[0, :2] = PLAYER_POS
+    rows[1:, :2] = [defs[:2] for defs in BALL_DEFS]
+    rows.flags.writeable = False
+    moving = np.zeros(len(BALL_DEFS) + 1, dtype = bool)
+    moving.flags.writeable = False
+
+    return TableState(rows, moving, (), 0, 0, None, Team.RED)
+
+# Double buffer holding the latest TableState published by the physics thread
+# States are immutable, so the renderer can keep drawing one while the next is written
+class StateBuffer:
+    def __init__(self):
+        self.buffers = [None, None]
+        self.front = 0
+
+    def publish(self, state):
+        back = 1 - self.front
+        self.buffers[back] = state
+        self.front = back
+
+    def latest(self):
+        return self.buffers[self.front]
+
+# What a shot pocketed
+class Outcome(enum.IntEnum):
+    NOTHING = 0
+    RED = 1
+    BLUE = 2
+    BOTH = 3
+
+# Append-only columnar shot archive; each column is a raw file of fixed-size values
+# Columns are read back as read-only memory maps, so queries are zero-copy NumPy filters
+class ShotArchive:
+    columns = {
+        "game": np.int32,
+        "team": np.int8,
+        "theta": np.float32,
+        "vel_main": np.float32,
+        "cue_x": np.float32,
+        "cue_y": np.float32,
+        # Bit i is set when BALL_POOL[i] was pocketed
+        "pocketed": np.uint32,
+        "pocketed_red": np.int8,
+        "pocketed_blue": np.int8,
+        "outcome": np.int8,
+        "cushions": np.int16,
+        "contacts": np.int16
+    }
+    # Columns with a row index
+    indexed = ["game", "team", "outcome"]
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+        self.trim()
+        self.files = {name: open(self.path(name), "ab") for name in self.columns}
+        self.indexes = {}
+
+    # Cuts every column back to the rows all columns have, so a partly written last row
+    # from a crash can't shift later appends; indexes over the cut rows are dropped
+    def trim(self):
+        sizes = {name: os.path.getsize(self.path(name)) if os.path.exists(self.path(name)) else 0 for name in self.columns}
+        rows = min(sizes[name] // np.dtype(dtype).itemsize for name, dtype in self.columns.items())
+
+        trimmed = False
+        for name, dtype in self.columns.items():
+            size = rows * np.dtype(dtype).itemsize
+            if sizes[name] > size:
+                os.truncate(self.path(name), size)
+                trimmed = True
+
+        if trimmed:
+            for name in self.indexed:
+                path = os.path.join(self.directory, name + ".index.npz")
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".bin")
+
+    def __len__(self):
+        for file in self.files.values():
+            file.flush()
+
+        return min(os.path.getsize(self.path(name)) // np.dtype(dtype).itemsize for name, dtype in self.columns.items())
+
+    # Appends one shot; values are keyed by column name
+    def append(self, **values):
+        for name, dtype in self.columns.items():
+            self.files[name].write(np.array(values[name], dtype = dtype).tobytes())
+
+    # Read-only memory map of a column
+    def column(self, name):
+        count = len(self)
+        if count == 0:
+            return np.empty(0, dtype = self.columns[name])
+
+        return np.memmap(self.path(name), dtype = self.columns[name], mode = "r", shape = (count,))
+
+    # Sorted keys, their start offsets and the rows grouped by key for an indexed column
+    # The index is kept on disk and rebuilt once rows were appended after it
+    def index(self, name):
+        count = len(self)
+        cached = self.indexes.get(name)
+        if cached is not None and cached[0] == count:
+            return cached[1:]
+
+        path = os.path.join(self.directory, name + ".index.npz")
+        if os.path.exists(path):
+            data = np.load(path)
+            if int(data["count"]) == count:
+                self.indexes[name] = (count, data["keys"], data["starts"], data["rows"])
+                return self.indexes[name][1:]
+
+        values = self.column(name)
+        rows = np.argsort(values, kind = "stable")
+        keys, starts = np.unique(values[rows], return_index = True)
+        np.savez(path, count = count, keys = keys, starts = starts, rows = rows)
+        self.indexes[name] = (count, keys, starts, rows)
+
+        return keys, starts, rows
+
+    # Rows matching every given indexed column, e.g. rows(team = Team.RED, outcome = Outcome.RED)
+    def rows(self, **keys):
+        found = None
+        for name, key in keys.items():
+            if isinstance(key, Team):
+                key = TEAMS.index(key)
+
+            index_keys, starts, rows = self.index(name)
+            i = np.searchsorted(index_keys, key)
+            if i == len(index_keys) or index_keys[i] != key:
+                return np.empty(0, dtype = np.int64)
+
+            end = starts[i + 1] if i + 1 < len(starts) else len(rows)
+            matched = rows[starts[i]:end]
+            found = matched if found is None else np.intersect1d(found, matched, assume_unique = True)
+
+        return np.arange(len(self)) if found is None else found
+
+    # Id for the next game
+    def next_game(self):
+        games = self.column("game")
+        return int(games.max()) + 1 if len(games) else 0
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
 # Game class to manage components
 class Game:
     def __init__(self, player):
         self.player = player
         self.components = []
+        self.layout = []
         self.pocketed_balls = []
         self.winner = None
         self.score_red = 0
         self.score_blue = 3
+        self.solver = ContactSolver()
+        # Runs the table instead of the Ball objects in fixed-point mode
+        self.fixed = FixedPointEngine() if args.physics == "fixed" else None
+        self.preview = AimPreview()
+        self.history = deque(maxlen = UNDO_LIMIT)
+
+        # Shot archive, the shooting team and the shot being played
+        self.archive = ShotArchive(args.archive) if args.archive else None
+        self.game_id = self.archive.next_game() if self.archive is not None else 0
+        self.team = Team.RED
+        self.shot = None
+
+        # Winner screen components, created once on the first win
+        self.winner_title = None
+        self.winner_button = None
 
     def add_component(self, component):
         self.components.append(component)
 
-    # Restarts the game
-    def restart_game(self):
-        global CURRENT_BALLS, CURRENT_BUTTONS
+    # Remembers the registered components as the table layout used on restart
+    def store_layout(self):
+        self.layout = list(self.components)
 
-        self.components.clear()
-        CURRENT_BALLS.clear()
-        CURRENT_BALLS = Ball.get_new_balls()
-        self.score_red, game.score_blue = 0, 0
+    # Restarts the game, reusing the pooled balls and buttons
+    def restart_game(self):
+        self.score_red, self.score_blue = 0, 0
         self.winner = None
-        self.pocketed_balls = []
-        game.reset_player()
+        self.pocketed_balls.clear()
+        self.history.clear()
+        self.game_id += 1
+        self.team = Team.RED
+        self.shot = None
+        self.reset_player()
         self.player.update()
-        CURRENT_BUTTONS.clear()
-        CURRENT_BUTTONS = Button.get_new_buttons()
+
+        Ball.reset_balls(BALL_POOL)
+        CURRENT_BALLS[:] = BALL_POOL
+        CURRENT_BUTTONS[:] = BUTTON_POOL
         TEXTS[0].update_text("Red: " + str(self.score_red))
         TEXTS[1].update_text("Blue: " + str(self.score_blue))
 
-        for platform in platforms:
-            self.add_component(platform)
-
-        for hole in HOLES:
-            self.add_component(hole)
-
-        for wall in WALLS:
-            self.add_component(wall)
-
-        for ball in CURRENT_BALLS:
-            self.add_component(ball)
-
-        for button in CURRENT_BUTTONS:
-            self.add_component(button)
-
-        for text in TEXTS:
-            self.add_component(text)
+        self.components[:] = self.layout
+        self.sync_fixed()
+
+    # Swaps the table for the winner screen
+    def show_winner_screen(self):
+        if self.winner_title is None:
+            self.winner_title = Text(text = self.winner.value + " wins!", size = 150, x = (WIDTH/3) + 30, y = HEIGHT / 2.5)
+            self.winner_button = Button(text = Text(text = "Restart", size = 60,x = 0, y = 0), x = (WIDTH/2.5) + 10, y = (HEIGHT/2) + 100, width = 300, height = 100, action = lambda: self.restart_game() if self.winner is not None else None)
+
+        self.winner_title.update_text(self.winner.value + " wins!")
+        self.components[:] = [self.winner_title, self.winner_button]
+        CURRENT_BUTTONS[:] = [self.winner_button]
+
+    # Captures the table into a TableState
+    def snapshot(self):
+        balls = [self.player] + BALL_POOL
+        rows = np.array([(b.x, b.y, b.vel_x, b.vel_y, b.theta, b.vel_main) for b in balls], dtype = np.float64)
+        rows.flags.writeable = False
+        moving = np.array([b.moving for b in balls], dtype = bool)
+        moving.flags.writeable = False
+        pocketed = tuple(BALL_POOL.index(b) for b in self.pocketed_balls)
+
+        return TableState(rows, moving, pocketed, self.score_red, self.score_blue, self.winner, self.team)
+
+    # Puts the table back to a TableState
+    def restore(self, state):
+        balls = [self.player] + BALL_POOL
+        for ball, row, moving in zip(balls, state.balls.tolist(), state.moving.tolist()):
+            ball.x, ball.y, ball.vel_x, ball.vel_y, ball.theta, ball.vel_main = row
+            ball.pos = (ball.x, ball.y)
+            ball.moving = moving
+
+        self.pocketed_balls[:] = [BALL_POOL[i] for i in state.pocketed]
+        self.score_red = state.score_red
+        self.score_blue = state.score_blue
+        self.winner = state.winner
+        self.team = state.team
+        self.shot = None
+        TEXTS[0].update_text("Red: " + str(self.score_red))
+        TEXTS[1].update_text("Blue: " + str(self.score_blue))
 
-        self.add_component(PLAYER)
+        pocketed = set(self.pocketed_balls)
+        CURRENT_BALLS[:] = [b for b in BALL_POOL if b not in pocketed]
+        if self.winner is None:
+            self.components[:] = [c for c in self.layout if c not in pocketed]
+            CURRENT_BUTTONS[:] = BUTTON_POOL
+        else:
+            self.show_winner_screen()
+
+        self.sync_fixed()
+
+    # Reloads the fixed-point engine after the balls were moved from outside it
+    def sync_fixed(self):
+        if self.fixed is not None:
+            self.fixed.load(self.snapshot())
+
+    # Advances the fixed-point engine and copies its state onto the balls
+    # Returns (wall hits, ball hits, newly pocketed balls)
+    def step_fixed(self):
+        if not self.fixed.is_moving():
+            return 0, 0, []
+
+        self.fixed.step()
+        positions, velocities, on_table = self.fixed.read()
+        for ball, (x, y), (vel_x, vel_y), moving in zip([self.player] + BALL_POOL, positions.tolist(), velocities.tolist(), self.fixed.moving.tolist()):
+            ball.x, ball.y = x, y
+            ball.pos = (x, y)
+            ball.vel_x, ball.vel_y = vel_x, vel_y
+            ball.moving = moving
+
+        pocketed = [BALL_POOL[i] for i in self.fixed.outcome()[len(self.pocketed_balls):]]
+        for ball in pocketed:
+            CURRENT_BALLS.remove(ball)
+
+        return self.fixed.wall_hits, self.fixed.ball_hits, pocketed
+
+    # Goes back to the table as it was before the last shot
+    def undo_shot(self):
+        if self.history:
+            self.restore(self.history.pop())
 
     # Resets the player's position
     def reset_player(self):
@@ -393,9 +1529,231 @@ class Game:
         self.player.y = PLAYER_POS[1]
         self.player.pos = PLAYER_POS
         self.player.vel_x, self.player.vel_y = 0, 0
+        self.sync_fixed()
+
+    # Strikes the cue ball
+    # In fixed-point mode a given integer aim is used as is, so live shots stay free of floats
+    def shoot(self, theta, vel_main, fixed_aim = None):
+        self.player.theta = theta
+        self.player.vel_main = max(MIN_BALL_SPEED, min(vel_main, MAX_BALL_SPEED))
+
+        # Saves the table so the shot can be undone
+        self.history.append(self.snapshot())
+
+        self.shot = {
+            "game": self.game_id,
+            "team": TEAMS.index(self.team),
+            "theta": self.player.theta,
+            "vel_main": self.player.vel_main,
+            "cue_x": self.player.x,
+            "cue_y": self.player.y,
+            "pocketed": 0,
+            "pocketed_red": 0,
+            "pocketed_blue": 0,
+            "cushions": 0,
+            "contacts": 0
+        }
+
+        # Changes the motion state
+        self.player.moving = True
+        if self.fixed is None:
+            self.player.set_update_vector()
+        else:
+            self.sync_fixed()
+            if fixed_aim is None:
+                self.fixed.shoot(self.player.theta, self.player.vel_main)
+            else:
+                self.fixed.shoot_fixed(*fixed_aim)
+        white_ball_hit_sound.play()
+
+    def is_moving(self):
+        return self.player.moving or any(ball.moving for ball in CURRENT_BALLS)
+
+    # Accumulates what the current shot did; the shot is archived once the table comes to rest
+    def record_shot(self, wall_hits, ball_hits, pocketed):
+        shot = self.shot
+        shot["cushions"] += wall_hits
+        shot["contacts"] += ball_hits
+        for ball in pocketed:
+            shot["pocketed"] |= 1 << BALL_POOL.index(ball)
+            if ball.color == Color.RED:
+                shot["pocketed_red"] += 1
+            else:
+                shot["pocketed_blue"] += 1
+
+        if self.winner is None and self.is_moving():
+            return
+
+        shot["outcome"] = (Outcome.RED if shot["pocketed_red"] else 0) | (Outcome.BLUE if shot["pocketed_blue"] else 0)
+        if self.archive is not None:
+            self.archive.append(**shot)
+
+        # The shooting team keeps the table only when it pocketed one of its own balls
+        own = shot["pocketed_red"] if self.team == Team.RED else shot["pocketed_blue"]
+        if not own:
+            self.team = TEAMS[1 - TEAMS.index(self.team)]
+
+        self.shot = None
+
+    # Advances the game by one frame
+    def step(self):
+        check_winner(self)
+        if self.winner is not None:
+            self.show_winner_screen()
+
+        # Update components; in fixed-point mode the engine moves the balls
+        if self.fixed is None:
+            for comp in self.components:
+                comp.update()
+
+        if self.winner is None:
+            if self.fixed is None:
+                wall_hits, ball_hits, pocketed = resolve_table(self.player, CURRENT_BALLS, self.solver)
+            else:
+                wall_hits, ball_hits, pocketed = self.step_fixed()
+
+            if wall_hits:
+                wall_hit_sound.play()
+
+            if ball_hits:
+                ball_hits_ball_sound.play()
+
+            for ball in pocketed:
+                self.components.remove(ball)
+                self.pocketed_balls.append(ball)
+                if ball.color == Color.RED:
+                    self.score_red += 1
+                    TEXTS[0].update_text("Red: " + str(self.score_red))
+                else:
+                    self.score_blue += 1
+                    TEXTS[1].update_text("Blue: " + str(self.score_blue))
+
+            if self.player.moving and self.fixed is None:
+                self.player.update()
+
+            if self.shot is not None:
+                self.record_shot(wall_hits, ball_hits, pocketed)
+        elif self.shot is not None:
+            self.record_shot(0, 0, [])
+
+    # Draws everything
+    def draw(self, surface):
+        surface.blit(sky_image, (0, 0))
+        for comp in self.components:
+            comp.draw(surface)
+
+    # Shoots unless the cue ball is already rolling; shots queued from the renderer can arrive late
+    def shoot_when_still(self, theta, vel_main, fixed_aim = None):
+        if not self.player.moving and self.winner is None:
+            self.shoot(theta, vel_main, fixed_aim)
+
+    # Draws a TableState instead of the live balls, keeping the layout's drawing order
+    def draw_state(self, surface, state):
+        surface.blit(sky_image, (0, 0))
+        if state.winner is not None:
+            self.winner_title.draw(surface)
+            self.winner_button.draw(surface)
+            return
+
+        for view, row in zip(self.view_balls.values(), state.balls.tolist()):
+            view.x, view.y = row[0], row[1]
+            view.pos = (view.x, view.y)
+        pocketed = {BALL_POOL[i] for i in state.pocketed}
+        for comp in self.layout:
+            if comp in pocketed:
+                continue
+
+            self.view_balls.get(comp, comp).draw(surface)
+
+    # Physics thread of the pipelined mode: runs commands, steps at FPS and publishes snapshots
+    # An error stops the loop and is kept for the renderer to raise
+    def physics_loop(self):
+        tick = 1 / FPS
+        next_time = time.perf_counter()
+        try:
+            while self.pipeline_running:
+                while not self.commands.empty():
+                    self.commands.get()()
+
+                self.step()
+                self.states.publish(self.snapshot())
+
+                next_time += tick
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Running behind; don't try to catch up
+                    next_time = time.perf_counter()
+        except Exception as error:
+            self.physics_error = error
+
+    # Renders the latest published snapshot while a worker thread runs the physics
+    # Input reaches the physics thread through the command queue
+    def run_pipelined(self):
+        # Ball copies the renderer draws from, keyed by the live ball; ordered like TableState rows
+        view_player = Player(*PLAYER_POS, radius = self.player.radius)
+        self.view_balls = dict(zip([self.player] + BALL_POOL, [view_player] + Ball.get_new_balls()))
+        self.states = StateBuffer()
+        self.states.publish(self.snapshot())
+        self.commands = queue.Queue()
+        self.pipeline_running = True
+        self.physics_error = None
+        worker = threading.Thread(target = self.physics_loop, daemon = True)
+        worker.start()
+
+        running = True
+        aim = view_player
+        sky_image.convert(screen)
+        while running:
+            # The physics thread is gone; stop instead of drawing a frozen table
+            if self.physics_error is not None:
+                raise self.physics_error
+            if not worker.is_alive():
+                raise RuntimeError("physics thread stopped")
+
+            state = self.states.latest()
+            aiming = state.winner is None and not state.moving[0]
+
+            # Event handling
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    running = False
+
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_z:
+                    self.commands.put(self.undo_shot)
+
+                if event.type == MOUSEBUTTONDOWN and aiming:
+                    fixed_aim = aim.get_fixed_aim() if self.fixed is not None else None
+                    self.commands.put(functools.partial(self.shoot_when_still, aim.theta, aim.vel_main, fixed_aim))
+
+                if event.type == MOUSEBUTTONUP and event.button == 1:
+                    for button in CURRENT_BUTTONS[:]:
+                        if button.rect.collidepoint(event.pos):
+                            self.commands.put(button.do_action)
+
+            self.draw_state(screen, state)
+
+            # Shows the direction pointed
+            if aiming:
+                aim.draw_direction(screen)
+                self.preview.request(aim.theta, aim.vel_main, state)
+                self.preview.draw(screen)
+
+            pygame.display.flip()
+            clock.tick(FPS)
+
+        self.pipeline_running = False
+        worker.join()
+        if self.archive is not None:
+            self.archive.close()
+        pygame.quit()
+        sys.exit()
 
     def run(self):
-        global CURRENT_BUTTONS, CURRENT_BALLS
+        if args.pipeline:
+            self.run_pipelined()
+
         running = True
         sky_image.convert(screen)
         while running:
@@ -404,114 +1762,38 @@ class Game:
                 if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
                     running = False
 
-                if event.type == MOUSEBUTTONDOWN and not self.player.moving and self.winner is None:
-                    if self.player.vel_main > MAX_BALL_SPEED:
-                        self.player.vel_main = MAX_BALL_SPEED
-                    elif self.player.vel_main < MIN_BALL_SPEED:
-                        self.player.vel_main = MIN_BALL_SPEED
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_z:
+                    self.undo_shot()
 
-                    # Changes the motion state
-                    self.player.moving = True
-                    self.player.set_update_vector()
-                    white_ball_hit_sound.play()
+                if event.type == MOUSEBUTTONDOWN and not self.player.moving and self.winner is None:
+                    self.shoot(self.player.theta, self.player.vel_main, self.player.get_fixed_aim() if self.fixed is not None else None)
 
                 if event.type == MOUSEBUTTONUP and event.button == 1:
                     for button in CURRENT_BUTTONS:
                         if button.rect.collidepoint(event.pos):
                             button.do_action()
 
-            check_winner(self)
-            if self.winner is not None:
-                self.components.clear()
-                winner_title = Text(text = self.winner.value + " wins!", size = 150, x = (WIDTH/3) + 30, y = HEIGHT / 2.5)
-                restart_button = Button(text = Text(text = "Restart", size = 60,x = 0, y = 0), x = (WIDTH/2.5) + 10, y = (HEIGHT/2) + 100, width = 300, height = 100, action = lambda: game.restart_game() if self.winner is not None else None)
-                self.components.append(winner_title)
-                self.components.append(restart_button)
-                CURRENT_BUTTONS = [restart_button]
+            self.step()
+            self.draw(screen)
 
-            # Update components
-            for comp in self.components:
-                comp.update()
-
-            # Draw everything
-            screen.blit(sky_image, (0, 0))
-            for comp in self.components:
-                comp.draw(screen)
-
-            if self.winner is None:
-                for wall in WALLS:
-                    if self.player.moving:
-                        wall_collision = wall.check_collision(self.player.x, self.player.y, self.player.radius)
-                        # Returns [hasCollided, isCollisionVertical]
-                        if wall_collision[0]:
-                            if wall_collision[1]:
-                                self.player.vel_x = -self.player.vel_x
-                            else:
-                                self.player.vel_y = -self.player.vel_y
-
-                            wall_hit_sound.play()
-
-                    # Checks for collision with other balls
-                    for ball in CURRENT_BALLS:
-                        if ball.moving:
-                            wall_collision = wall.check_collision(ball.x, ball.y, ball.radius)
-                            # Returns [hasCollided, isCollisionVertical]
-                            if wall_collision[0]:
-                                if wall_collision[1]:
-                                    ball.vel_x = -ball.vel_x
-                                else:
-                                    ball.vel_y = -ball.vel_y
-
-                                wall_hit_sound.play()
-
-                for i, ball in enumerate(CURRENT_BALLS):
-                    Ball.displace_overlap(ball, self.player)
-
-                    # Check collision with player
-                    if ball.check_ball_collision(self.player):
-                        ball.collide(self.player)
-
-                        if self.player.moving or ball:
-                            ball_hits_ball_sound.play()
-
-                    # Check collision with other balls
-                    for j in range(i + 1, len(CURRENT_BALLS)):
-                        ball2 = CURRENT_BALLS[j]
-                        Ball.displace_overlap(ball, ball2)
-                        if ball.check_ball_collision(ball2):
-                            ball.collide(ball2)
-
-                            if ball.moving or ball2.moving:
-                                ball_hits_ball_sound.play()
-
-                    # Checks if any ball went inside the hole
-                    for hole in HOLES:
-                        if hole.check_ball_in_hole(ball):
-                            CURRENT_BALLS.remove(ball)
-                            self.components.remove(ball)
-                            self.pocketed_balls.append(ball)
-                            if ball.color == Color.RED:
-                                self.score_red += 1
-                                TEXTS[0].update_text("Red: " + str(self.score_red))
-                            else:
-                                self.score_blue += 1
-                                TEXTS[1].update_text("Blue: " + str(self.score_blue))
-
-                # Shows the direction pointed
-                if not self.player.moving:
-                    self.player.draw_direction(screen)
-
-                if self.player.moving:
-                    self.player.update()
+            # Shows the direction pointed
+            if self.winner is None and not self.player.moving:
+                self.player.draw_direction(screen)
+                self.preview.request(self.player.theta, self.player.vel_main, self.snapshot())
+                self.preview.draw(screen)
 
             pygame.display.flip()
             clock.tick(FPS)
 
+        if self.archive is not None:
+            self.archive.close()
         pygame.quit()
         sys.exit()
 
 # Game objects
-CURRENT_BUTTONS = Button.get_new_buttons()
+# Pools are built once; restarts reset them in place instead of reallocating
+BUTTON_POOL = Button.get_new_buttons()
+CURRENT_BUTTONS = list(BUTTON_POOL)
 PLAYER = Player(x = 500, y = 400, radius = 15)
 WALLS = [
     Wall(x = 40, y = 40, width = 60, height = 820),
@@ -519,7 +1801,8 @@ WALLS = [
     Wall(x = 1500, y = 40, width = 60, height = 820),
     Wall(x = 100, y = 800, width = 1400, height = 60)
 ]
-CURRENT_BALLS = Ball.get_new_balls()
+BALL_POOL = Ball.get_new_balls()
+CURRENT_BALLS = list(BALL_POOL)
 HOLES = [
     Hole(x = 120, y = 120, radius = 40),
     Hole(x = 780, y = 120, radius = 40),
@@ -561,6 +1844,35 @@ for text in TEXTS:
     game.add_component(text)
 
 game.add_component(PLAYER)
+game.store_layout()
+
+# Golden physics trajectories
+if args.golden:
+    harness = GoldenHarness(shots = args.golden_shots)
+    if args.golden == "record":
+        harness.record()
+        harness.save(args.golden_file)
+        print("Recorded", args.golden_shots, "shots to", args.golden_file)
+    else:
+        harness.load(args.golden_file)
+        harness.report([ReferenceEngine(), SolverEngine(), FixedPointEngine()])
+
+    pygame.quit()
+    sys.exit()
+
+# Offscreen frame export
+if args.export:
+    exporter = FrameExporter(args.export, tuple(args.export_size), args.export_format, args.export_workers)
+    start = time.perf_counter()
+    exporter.export(game, [GoldenHarness.make_shot(seed) for seed in range(args.export_shots)])
+    exporter.close()
+    if game.archive is not None:
+        game.archive.close()
+    elapsed = time.perf_counter() - start
+    print("Exported", exporter.count, "frames to", args.export, "in", round(elapsed, 2), "s,", round(exporter.count / elapsed / FPS, 1), "x real time")
+
+    pygame.quit()
+    sys.exit()
 
 # Run the game
 